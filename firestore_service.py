@@ -1,12 +1,20 @@
 import os
 from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
 from google.api_core.exceptions import GoogleAPICallError
 import hashlib
-from datetime import datetime
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import islice
 import logging
 
 # Importa a função de upload do GCS
 from gcs_service import upload_media_to_gcs
+from parser import ParsedMessage
 
 # Configuração básica de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,49 +26,209 @@ except Exception as e:
     logging.error(f"Não foi possível inicializar o cliente do Firestore: {e}")
     db = None
 
+# Valores de `nlp_status` / `media_analysis_status`
+STATUS_PENDING = "pending"
+STATUS_NOT_APPLICABLE = "not_applicable"
+STATUS_UPLOAD_FAILED = "upload_failed"
+
+# Número de uploads de mídia executados em paralelo por ingestão
+MEDIA_UPLOAD_WORKERS = int(os.getenv("MEDIA_UPLOAD_WORKERS", "16"))
+
+# Número de mensagens por bloco na verificação de existência (`get_all` por IDs)
+EXISTENCE_CHECK_CHUNK_SIZE = 300
+
+# Número máximo de tentativas de uma escrita no BulkWriter antes de desistir
+BULK_WRITE_MAX_ATTEMPTS = 10
+
+# Limites de vazão do BulkWriter (escritas por segundo). O padrão da biblioteca
+# (500/s, inicial e máximo) limitaria as importações grandes; os IDs das
+# mensagens são hashes SHA-256, sem chaves sequenciais a proteger. Sem
+# `BULK_WRITE_MAX_OPS_PER_SECOND`, a vazão não tem teto no cliente.
+BULK_WRITE_INITIAL_OPS_PER_SECOND = int(os.getenv("BULK_WRITE_INITIAL_OPS_PER_SECOND", "5000"))
+_bulk_write_max_ops = os.getenv("BULK_WRITE_MAX_OPS_PER_SECOND")
+BULK_WRITE_MAX_OPS_PER_SECOND = int(_bulk_write_max_ops) if _bulk_write_max_ops else None
+
+# Fila de eventos do log do sistema, gravados em batch por uma thread dedicada
+SYSTEM_LOG_BATCH_SIZE = 50
+SYSTEM_LOG_BATCH_WAIT_SECONDS = 0.1
+_system_log_queue = queue.Queue()
+
+@lru_cache(maxsize=4096)
 def get_group_id(group_name: str) -> str:
     """Gera um ID determinístico para o grupo a partir do seu nome."""
     return hashlib.sha1(group_name.encode('utf-8')).hexdigest()
 
-def get_message_id(timestamp: datetime, author: str, text_preview: str) -> str:
+def get_message_id(timestamp_bytes: bytes, author_bytes: bytes, preview_bytes: bytes) -> str:
     """
     Gera um ID determinístico para a mensagem para garantir a idempotência.
-    Usa timestamp, autor e um preview do texto.
+    Usa timestamp, autor e um preview do texto, já codificados em bytes (ver
+    `encode_message_id_parts`).
+    """
+    # O digest é idêntico ao de f"{timestamp}-{author}-{preview}", preservando
+    # os IDs já gravados.
+    h = hashlib.sha256(timestamp_bytes)
+    h.update(b'-')
+    h.update(author_bytes)
+    h.update(b'-')
+    h.update(preview_bytes)
+    return h.hexdigest()
+
+def encode_message_id_parts(msg: ParsedMessage) -> (bytes, bytes, bytes):
     """
-    preview = text_preview[:50]
-    ts_str = timestamp.isoformat()
-    unique_string = f"{ts_str}-{author}-{preview}"
-    return hashlib.sha256(unique_string.encode('utf-8')).hexdigest()
+    Codifica uma única vez os campos da mensagem usados em `get_message_id`:
+    timestamp ISO, autor e os 50 primeiros caracteres do texto.
+    """
+    return (
+        msg.timestamp_utc.isoformat().encode('ascii'),
+        msg.author.encode('utf-8'),
+        msg.message_text[:50].encode('utf-8')
+    )
 
 def log_system_event(task_id: str, source: str, details: str, status: str):
     """
     Registra um evento no log do sistema no Firestore.
+
+    A escrita é enfileirada e feita em background por `_drain_system_logs`, sem
+    bloquear quem chama. Eventos de uma mesma tarefa são gravados na ordem em que
+    foram registrados.
     """
     if not db:
         logging.error("Cliente Firestore não inicializado. Não é possível registrar o log do sistema.")
         return
-    try:
-        log_ref = db.collection('system_logs').document(task_id)
-        log_data = {
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'source': source,
-            'details': details,
-            'status': status
-        }
-        log_ref.set(log_data, merge=True)
-    except GoogleAPICallError as e:
-        logging.error(f"Erro ao registrar log no Firestore: {e}")
-
-def process_and_save_messages(group_name: str, messages: list, media_files_map: dict, gcs_bucket_name: str):
+    _system_log_queue.put((task_id, {
+        'timestamp': firestore.SERVER_TIMESTAMP,
+        'source': source,
+        'details': details,
+        'status': status
+    }))
+
+def flush_system_logs():
+    """Bloqueia até que todos os eventos enfileirados tenham sido gravados."""
+    _system_log_queue.join()
+
+def _drain_system_logs():
+    """
+    Consome a fila de eventos do log do sistema, agrupando até
+    `SYSTEM_LOG_BATCH_SIZE` eventos (ou o que chegar em
+    `SYSTEM_LOG_BATCH_WAIT_SECONDS`) em um único commit.
+    """
+    while True:
+        events = [_system_log_queue.get()]
+        deadline = time.monotonic() + SYSTEM_LOG_BATCH_WAIT_SECONDS
+        while len(events) < SYSTEM_LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(_system_log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            batch = db.batch()
+            for task_id, log_data in events:
+                batch.set(db.collection('system_logs').document(task_id), log_data, merge=True)
+            batch.commit()
+        except GoogleAPICallError as e:
+            logging.error(f"Erro ao registrar log no Firestore: {e}")
+        except Exception as e:
+            logging.error(f"Erro inesperado ao registrar log no Firestore: {e}", exc_info=True)
+        finally:
+            for _ in events:
+                _system_log_queue.task_done()
+
+if db:
+    threading.Thread(target=_drain_system_logs, name="system-log-writer", daemon=True).start()
+
+def fetch_existing_message_ids(messages_ref, message_ids: list) -> set:
+    """
+    Retorna quais dos `message_ids` já existem na sub-coleção `messages_ref`.
+
+    Consulta apenas os IDs candidatos, em um único `get_all`, em vez de ler
+    toda a sub-coleção, e usa `field_paths=[]` para não transferir o conteúdo
+    dos documentos. `process_and_save_messages` chama esta função uma vez por
+    bloco de `EXISTENCE_CHECK_CHUNK_SIZE` mensagens.
+    """
+    unique_ids = list(dict.fromkeys(message_ids))
+    if not unique_ids:
+        return set()
+
+    refs = [messages_ref.document(message_id) for message_id in unique_ids]
+    return {snap.id for snap in db.get_all(refs, field_paths=[]) if snap.exists}
+
+def _to_epoch_ms(timestamp: datetime) -> int:
+    """Converte um datetime sem fuso (UTC) em milissegundos desde a época Unix."""
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def get_ingested_high_water_mark(group_ref, messages_ref) -> datetime:
+    """
+    Retorna um limite superior para o `timestamp_utc` das mensagens já salvas
+    no grupo (`last_message_timestamp_ms`).
+
+    Mensagens posteriores a esse valor são garantidamente novas e dispensam a
+    verificação de existência. Se o campo ainda não existe (grupo novo ou
+    ingerido antes do campo existir), o valor é obtido da mensagem mais recente
+    já salva, ou `datetime.min` se não houver nenhuma.
+    """
+    snapshot = group_ref.get(field_paths=['last_message_timestamp_ms'])
+    high_water_mark_ms = (snapshot.to_dict() or {}).get('last_message_timestamp_ms') if snapshot.exists else None
+    if high_water_mark_ms is not None:
+        return datetime(1970, 1, 1) + timedelta(milliseconds=high_water_mark_ms)
+
+    latest = (
+        messages_ref.order_by('timestamp_utc', direction=firestore.Query.DESCENDING)
+        .select(['timestamp_utc'])
+        .limit(1)
+        .get()
+    )
+    if not latest:
+        return datetime.min
+    # O Firestore devolve datetimes com fuso (UTC); as mensagens parseadas não têm fuso
+    return latest[0].get('timestamp_utc').replace(tzinfo=None)
+
+def advance_high_water_mark(group_ref, timestamp: datetime, group_data: dict = None):
+    """
+    Avança `last_message_timestamp_ms` do grupo para `timestamp`, se for maior.
+
+    Usa a transformação `Maximum` do Firestore: o valor nunca retrocede, mesmo
+    com ingestões simultâneas do mesmo grupo, com uma única escrita, sem
+    leitura nem transação. Campos em `group_data` (metadados do grupo) são
+    gravados na mesma escrita.
+    """
+    data = dict(group_data or {})
+    data['last_message_timestamp_ms'] = firestore.Maximum(_to_epoch_ms(timestamp))
+    group_ref.set(data, merge=True)
+
+def _build_message_data(msg: ParsedMessage) -> dict:
+    """Monta o documento do Firestore para uma mensagem parseada."""
+    return {
+        "timestamp_utc": msg.timestamp_utc,
+        "author": msg.author,
+        "message_text": msg.message_text,
+        "is_system_message": msg.is_system_message,
+        "has_media": msg.has_media,
+        "nlp_status": STATUS_PENDING,
+        "media_analysis_status": STATUS_PENDING if msg.has_media else STATUS_NOT_APPLICABLE
+    }
+
+def process_and_save_messages(group_name: str, messages, media_files_map: dict, gcs_bucket_name: str) -> int:
     """
     Processa mensagens, faz upload de mídias associadas para o GCS com o caminho
     correto e salva os metadados no Firestore de forma idempotente.
 
+    As mensagens são consumidas em blocos, de modo que `messages` pode ser um
+    gerador: cada bloco tem sua existência verificada e suas mensagens sem mídia
+    enviadas ao BulkWriter enquanto os uploads de mídia seguem em paralelo. As
+    mensagens com mídia são gravadas conforme seus uploads terminam.
+
     Args:
         group_name (str): O nome do grupo do WhatsApp.
-        messages (list): A lista de mensagens parseadas.
+        messages (iterable): As mensagens parseadas (`ParsedMessage`).
         media_files_map (dict): Mapeia `media_filename` para o seu caminho local (`media_path`).
         gcs_bucket_name (str): O nome do bucket do GCS para upload.
+
+    Returns:
+        int: O número de mensagens recebidas em `messages`.
     """
     if not db:
         raise ConnectionError("Conexão com o Firestore não está disponível.")
@@ -68,83 +236,137 @@ def process_and_save_messages(group_name: str, messages: list, media_files_map:
     group_id = get_group_id(group_name)
     group_ref = db.collection('whatsapp_groups').document(group_id)
     messages_ref = group_ref.collection('messages')
-    
+
+    # Valor lido no início: mensagens posteriores a ele não existiam antes desta ingestão
+    high_water_mark = get_ingested_high_water_mark(group_ref, messages_ref)
+    # Valor já persistido por esta ingestão
+    persisted_high_water_mark = high_water_mark
+
+    # Metadados do grupo, gravados junto com o primeiro avanço do high-water
+    # mark (ou ao final, se nenhum bloco o avançar). Assim o documento do grupo
+    # já nasce com `group_name`, mesmo se a ingestão for interrompida.
+    group_data = {
+        'group_name': group_name,
+        'last_ingestion_date': firestore.SERVER_TIMESTAMP
+    }
+
+    failed_writes = []
+
+    def on_write_error(failure, _bulk_writer) -> bool:
+        if failure.attempts < BULK_WRITE_MAX_ATTEMPTS:
+            return True
+        failed_writes.append(failure)
+        logging.error(f"Erro ao salvar mensagem do grupo '{group_name}' após {failure.attempts} tentativas: {failure.message}")
+        return False
+
+    # O BulkWriter divide as escritas em batches, mantém vários commits em
+    # paralelo e refaz as escritas com falha.
+    bulk_writer = db.bulk_writer(options=BulkWriterOptions(
+        initial_ops_per_second=BULK_WRITE_INITIAL_OPS_PER_SECOND,
+        max_ops_per_second=BULK_WRITE_MAX_OPS_PER_SECOND
+    ))
+    bulk_writer.on_write_error(on_write_error)
+
+    received_count = 0
+    existing_count = 0
+    new_count = 0
+    upload_futures = {}  # Mapeia future -> (message_id, message_data, media_filename)
+
+    # O BulkWriter é sempre fechado, mesmo se o parsing ou uma consulta falhar,
+    # para que as escritas já enfileiradas sejam enviadas e suas threads encerradas.
     try:
-        group_ref.set({
-            'group_name': group_name,
-            'last_ingestion_date': firestore.SERVER_TIMESTAMP
-        }, merge=True)
-    except GoogleAPICallError as e:
-        logging.error(f"Erro ao atualizar metadados do grupo '{group_name}': {e}")
-
-    batch = db.batch()
-    saved_count = 0
-    
-    existing_message_ids = {doc.id for doc in messages_ref.stream()}
-    logging.info(f"Encontradas {len(existing_message_ids)} mensagens existentes para o grupo '{group_name}'.")
-
-    for msg in messages:
-        message_id = get_message_id(
-            msg['timestamp_utc'],
-            msg['author'],
-            msg['message_text']
-        )
-
-        if message_id in existing_message_ids:
-            continue
-
-        doc_ref = messages_ref.document(message_id)
-        
-        message_data = {
-            "timestamp_utc": msg['timestamp_utc'],
-            "author": msg['author'],
-            "message_text": msg['message_text'],
-            "is_system_message": msg['is_system_message'],
-            "has_media": msg['has_media'],
-            "nlp_status": "pending",
-            "media_analysis_status": "pending" if msg['has_media'] else "not_applicable"
-        }
-
-        # Se a mensagem tiver mídia, faz o upload para o GCS
-        if msg['has_media'] and msg['media_filename'] in media_files_map:
-            media_filename = msg['media_filename']
-            media_local_path = media_files_map[media_filename]
-            
-            # Constrói o caminho de destino no GCS
-            destination_blob = f"whatsapp/groups/{group_id}/messages/{message_id}/{media_filename}"
-            
-            gcs_uri, file_hash, media_type = upload_media_to_gcs(
-                file_path=media_local_path,
-                bucket_name=gcs_bucket_name,
-                destination_blob_name=destination_blob
-            )
-            
-            if gcs_uri:
-                message_data['media'] = {
-                    "original_filename": media_filename,
-                    "gcs_uri": gcs_uri,
-                    "hash_sha256": file_hash,
-                    "media_type": media_type
-                }
-            else:
-                # Se o upload falhar, marca como pendente para uma nova tentativa
-                message_data['media_analysis_status'] = 'upload_failed'
-                logging.warning(f"Falha no upload da mídia '{media_filename}' para a mensagem '{message_id}'.")
-
-        batch.set(doc_ref, message_data)
-        saved_count += 1
-        
-        if saved_count % 499 == 0:
-            logging.info(f"Commitando batch com {saved_count} mensagens...")
-            batch.commit()
-            batch = db.batch()
+        with ThreadPoolExecutor(max_workers=MEDIA_UPLOAD_WORKERS) as upload_executor:
+            messages_iter = iter(messages)
+            while True:
+                chunk = list(islice(messages_iter, EXISTENCE_CHECK_CHUNK_SIZE))
+                if not chunk:
+                    break
+                received_count += len(chunk)
 
-    if saved_count > 0:
-        try:
-            batch.commit()
-            logging.info(f"Commit final. {saved_count} novas mensagens salvas para o grupo '{group_name}'.")
-        except GoogleAPICallError as e:
-            logging.error(f"Erro no commit final do batch para o grupo '{group_name}': {e}")
+                # 1. Verificar quais mensagens do bloco já existem. Só mensagens até o
+                # high-water mark podem já ter sido salvas.
+                message_ids = [get_message_id(*encode_message_id_parts(msg)) for msg in chunk]
+                candidate_ids = [
+                    message_id
+                    for message_id, msg in zip(message_ids, chunk)
+                    if msg.timestamp_utc <= high_water_mark
+                ]
+                existing_message_ids = fetch_existing_message_ids(messages_ref, candidate_ids)
+                existing_count += len(existing_message_ids)
+                new_messages = [
+                    (message_id, msg)
+                    for message_id, msg in zip(message_ids, chunk)
+                    if message_id not in existing_message_ids
+                ]
+
+                # 2. Avançar o high-water mark antes de gravar o bloco. Avançar é
+                # sempre seguro (mensagens até ele continuam sendo verificadas); o
+                # que não pode acontecer é existir mensagem salva acima dele, mesmo
+                # se alguma escrita falhar ou a ingestão for interrompida.
+                block_latest = max((msg.timestamp_utc for _, msg in new_messages), default=None)
+                if block_latest is not None and block_latest > persisted_high_water_mark:
+                    advance_high_water_mark(group_ref, block_latest, group_data)
+                    persisted_high_water_mark = block_latest
+                    group_data = None
+
+                # 3. Gravar as mensagens novas sem mídia e agendar os uploads das demais
+                for message_id, msg in new_messages:
+                    new_count += 1
+                    message_data = _build_message_data(msg)
+
+                    if msg.has_media and msg.media_filename in media_files_map:
+                        media_filename = msg.media_filename
+                        future = upload_executor.submit(
+                            upload_media_to_gcs,
+                            file_path=media_files_map[media_filename],
+                            bucket_name=gcs_bucket_name,
+                            # Constrói o caminho de destino no GCS
+                            destination_blob_name=f"whatsapp/groups/{group_id}/messages/{message_id}/{media_filename}"
+                        )
+                        upload_futures[future] = (message_id, message_data, media_filename)
+                    else:
+                        bulk_writer.set(messages_ref.document(message_id), message_data)
+
+            logging.info(f"Encontradas {existing_count} mensagens existentes para o grupo '{group_name}'.")
+            if upload_futures:
+                logging.info(f"Aguardando {len(upload_futures)} uploads de mídia para o GCS...")
+
+            # 4. Gravar as mensagens com mídia conforme os uploads terminam
+            for future in as_completed(upload_futures):
+                message_id, message_data, media_filename = upload_futures[future]
+                gcs_uri, file_hash, media_type = future.result()
+
+                if gcs_uri:
+                    message_data['media'] = {
+                        "original_filename": media_filename,
+                        "gcs_uri": gcs_uri,
+                        "hash_sha256": file_hash,
+                        "media_type": media_type
+                    }
+                else:
+                    # Se o upload falhar, marca como pendente para uma nova tentativa
+                    message_data['media_analysis_status'] = STATUS_UPLOAD_FAILED
+                    logging.warning(f"Falha no upload da mídia '{media_filename}' para a mensagem '{message_id}'.")
+
+                bulk_writer.set(messages_ref.document(message_id), message_data)
+    finally:
+        bulk_writer.close()
+
+    if not received_count:
+        # Nada foi parseado: não cria nem atualiza o documento do grupo
+        return 0
+
+    if new_count:
+        saved_count = new_count - len(failed_writes)
+        logging.info(f"Commit final. {saved_count} novas mensagens salvas para o grupo '{group_name}'.")
     else:
         logging.info(f"Nenhuma mensagem nova para salvar para o grupo '{group_name}'.")
 
+    # 5. Atualizar os metadados do grupo, se ainda não foram gravados com o high-water mark
+    if group_data is not None:
+        try:
+            group_ref.set(group_data, merge=True)
+        except GoogleAPICallError as e:
+            logging.error(f"Erro ao atualizar metadados do grupo '{group_name}': {e}")
+
+    return received_count
@@ -1,35 +1,108 @@
 import os
+import sys
+import mmap
 import hashlib
 import mimetypes
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
-from google.api_core.exceptions import GoogleAPICallError, NotFound
+from requests.adapters import HTTPAdapter
+from google.api_core.exceptions import GoogleAPICallError, NotFound, PreconditionFailed
 import logging
 
 # Configuração básica de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Tamanho do pool de conexões HTTP do cliente do GCS. O cliente é compartilhado
+# por até `INGESTION_WORKERS` ingestões simultâneas, cada uma com
+# `MEDIA_UPLOAD_WORKERS` uploads em paralelo; o padrão da biblioteca (10) faria
+# as conexões excedentes serem descartadas a cada upload.
+GCS_HTTP_POOL_SIZE = int(os.getenv(
+    "GCS_HTTP_POOL_SIZE",
+    str(int(os.getenv("INGESTION_WORKERS", "4")) * int(os.getenv("MEDIA_UPLOAD_WORKERS", "16")))
+))
+
 # Inicializa o cliente do GCS
 try:
-    storage_client = storage.Client()
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    http_session = AuthorizedSession(credentials)
+    http_session.mount("https://", HTTPAdapter(
+        pool_connections=GCS_HTTP_POOL_SIZE,
+        pool_maxsize=GCS_HTTP_POOL_SIZE
+    ))
+    storage_client = storage.Client(project=project, credentials=credentials, _http=http_session)
 except Exception as e:
     logging.error(f"Não foi possível inicializar o cliente do Google Cloud Storage: {e}")
     storage_client = None
 
+# Tamanho das fatias do memoryview usadas no fallback via mmap (controle de RSS)
+HASH_MMAP_CHUNK_SIZE = 8 * 1024 * 1024
+
 def calculate_file_hash(file_path: str) -> str:
-    """Calcula o hash SHA-256 de um arquivo."""
-    sha256_hash = hashlib.sha256()
+    """
+    Calcula o hash SHA-256 de um arquivo.
+
+    No Python 3.11+ usa `hashlib.file_digest`, que executa todo o loop de leitura
+    em C. Em versões anteriores, mapeia o arquivo em memória e alimenta o hash
+    em fatias de 8 MiB.
+    """
     with open(file_path, "rb") as f:
-        # Lê o arquivo em chunks para não sobrecarregar a memória
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+        sha256_hash = hashlib.sha256()
+        # mmap não aceita arquivos vazios
+        if os.fstat(f.fileno()).st_size == 0:
+            return sha256_hash.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for offset in range(0, len(view), HASH_MMAP_CHUNK_SIZE):
+                    sha256_hash.update(view[offset:offset + HASH_MMAP_CHUNK_SIZE])
+            finally:
+                view.release()
     return sha256_hash.hexdigest()
 
+# Tipos MIME das extensões usadas nas exportações do WhatsApp, evitando
+# `mimetypes.guess_type` para os casos comuns
+WHATSAPP_MEDIA_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.mp4': 'video/mp4',
+    '.3gp': 'video/3gpp',
+    '.mov': 'video/quicktime',
+    '.opus': 'audio/ogg',
+    '.ogg': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.mp3': 'audio/mpeg',
+    '.aac': 'audio/aac',
+    '.pdf': 'application/pdf',
+    '.vcf': 'text/vcard',
+}
+
+def get_media_type(filename: str, extension: str) -> str:
+    """Determina o tipo MIME de um arquivo de mídia a partir da sua extensão."""
+    media_type = WHATSAPP_MEDIA_TYPES.get(extension.lower())
+    if media_type:
+        return media_type
+    media_type, _ = mimetypes.guess_type(filename)
+    return media_type or 'application/octet-stream'
+
+# Prefixo dos blobs canônicos, endereçados pelo conteúdo (`objects/{sha256}{ext}`)
+CANONICAL_OBJECTS_PREFIX = "objects"
+
 def upload_media_to_gcs(file_path: str, bucket_name: str, destination_blob_name: str = None) -> (str, str, str):
     """
     Faz o upload de um arquivo de mídia para o Google Cloud Storage de forma idempotente.
 
     Se `destination_blob_name` for fornecido, ele é usado como o caminho/nome do arquivo no GCS.
-    A verificação de existência é feita nesse caminho.
+    O conteúdo é enviado uma única vez para um blob canônico `objects/{sha256}{ext}`
+    e copiado no servidor para o destino, de modo que a mesma mídia em grupos ou
+    mensagens diferentes não é reenviada. Um destino já existente (nova
+    tentativa após uma falha) é mantido.
 
     Se `destination_blob_name` não for fornecido, a idempotência é garantida
     usando o hash do arquivo como nome do blob na raiz do bucket.
@@ -52,38 +125,44 @@ def upload_media_to_gcs(file_path: str, bucket_name: str, destination_blob_name:
         return None, None, None
 
     try:
-        # 1. Calcular o hash do arquivo (útil para metadados, independente do nome do blob)
-        file_hash = calculate_file_hash(file_path)
-        
-        # 2. Determinar o tipo MIME
+        # 1. Determinar o tipo MIME
         original_filename = os.path.basename(file_path)
-        media_type, _ = mimetypes.guess_type(original_filename)
-        media_type = media_type or 'application/octet-stream'
+        _, extension = os.path.splitext(original_filename)
+        media_type = get_media_type(original_filename, extension)
+
+        bucket = storage_client.bucket(bucket_name)
 
-        # 3. Definir o nome do blob
+        # 2. Enviar o conteúdo para o blob endereçado pelo hash
+        file_hash = calculate_file_hash(file_path)
         if destination_blob_name:
-            blob_name = destination_blob_name
+            content_blob_name = f"{CANONICAL_OBJECTS_PREFIX}/{file_hash}{extension}"
         else:
             # Comportamento legado: usa o hash como nome na raiz
-            _, extension = os.path.splitext(original_filename)
-            blob_name = f"{file_hash}{extension}"
+            content_blob_name = f"{file_hash}{extension}"
+        content_blob = bucket.blob(content_blob_name)
+        content_blob.metadata = {'sha256': file_hash}
 
-        gcs_uri = f"gs://{bucket_name}/{blob_name}"
+        # A pré-condição `if_generation_match=0` faz o GCS rejeitar o upload com
+        # 412 quando o objeto já existe, dispensando uma chamada `exists()` prévia.
+        try:
+            logging.info(f"Fazendo upload de '{original_filename}' para 'gs://{bucket_name}/{content_blob_name}'...")
+            content_blob.upload_from_filename(file_path, content_type=media_type, if_generation_match=0)
+            logging.info(f"Upload de '{original_filename}' concluído com sucesso.")
+        except PreconditionFailed:
+            logging.info(f"Conteúdo de '{original_filename}' já existe em 'gs://{bucket_name}/{content_blob_name}'. Pulando upload.")
 
-        # 4. Verificar se o blob já existe (lógica de idempotência)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-
-        if blob.exists():
-            logging.info(f"Mídia já existe no GCS em '{gcs_uri}'. Pulando upload de '{original_filename}'.")
-            return gcs_uri, file_hash, media_type
-
-        # 5. Fazer o upload se não existir
-        logging.info(f"Fazendo upload de '{original_filename}' para '{gcs_uri}'...")
-        blob.upload_from_filename(file_path, content_type=media_type)
-        
-        logging.info(f"Upload de '{original_filename}' concluído com sucesso.")
-        return gcs_uri, file_hash, media_type
+        if not destination_blob_name:
+            return f"gs://{bucket_name}/{content_blob_name}", file_hash, media_type
+
+        # 3. Copiar o blob canônico para o destino (cópia no servidor, sem tráfego).
+        # Os uploads só são feitos para mensagens novas, então o destino quase
+        # nunca existe; quando existe (nova tentativa após uma falha), a
+        # pré-condição faz o GCS recusar a cópia, sem uma consulta prévia.
+        try:
+            bucket.copy_blob(content_blob, bucket, destination_blob_name, if_generation_match=0)
+        except PreconditionFailed:
+            logging.info(f"Mídia '{original_filename}' já existe em 'gs://{bucket_name}/{destination_blob_name}'.")
+        return f"gs://{bucket_name}/{destination_blob_name}", file_hash, media_type
 
     except FileNotFoundError:
         logging.error(f"Arquivo de mídia não encontrado em: {file_path}")
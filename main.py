@@ -1,15 +1,22 @@
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import io
 import os
 import shutil
 import uuid
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
 from dotenv import load_dotenv
 
-from parser import parse_whatsapp_chat
-from firestore_service import process_and_save_messages, log_system_event
+from parser import extract_group_name, iter_whatsapp_messages
+from firestore_service import process_and_save_messages, log_system_event, flush_system_logs
 
 # Carrega as variáveis de ambiente do arquivo .env
 load_dotenv()
@@ -46,6 +53,140 @@ GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
 if not GCP_PROJECT_ID or not GCS_BUCKET_NAME:
     raise RuntimeError("Variáveis de ambiente GCP_PROJECT_ID e GCS_BUCKET_NAME devem ser definidas.")
 
+# Número de arquivos .zip processados simultaneamente em background
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "4"))
+
+# Diretórios temporários já processados são movidos para cá e removidos em background
+TRASH_DIR = "/tmp/.trash"
+TRASH_SWEEP_INTERVAL_SECONDS = 30
+
+def discard_temp_dir(temp_dir: str):
+    """
+    Move `temp_dir` para `TRASH_DIR` (um rename, O(1) no mesmo filesystem) para
+    que a remoção dos arquivos seja feita pelo `_trash_sweeper`, fora do fluxo da
+    tarefa. Se o rename falhar, remove o diretório diretamente.
+    """
+    try:
+        os.rename(temp_dir, os.path.join(TRASH_DIR, os.path.basename(temp_dir)))
+    except OSError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def _trash_sweeper():
+    """Remove periodicamente o conteúdo de `TRASH_DIR`."""
+    while True:
+        try:
+            with os.scandir(TRASH_DIR) as entries:
+                for entry in entries:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError as e:
+            logging.error(f"Erro ao limpar o diretório {TRASH_DIR}: {e}")
+        time.sleep(TRASH_SWEEP_INTERVAL_SECONDS)
+
+# Número de threads usadas para descompactar o .zip recebido
+ZIP_EXTRACT_WORKERS = 8
+
+# Tamanho do buffer de leitura de cada worker ao descompactar a partir do upload
+ZIP_READ_BUFFER_SIZE = 1024 * 1024
+
+class _PositionalFile(io.RawIOBase):
+    """
+    Leitor somente-leitura sobre um descritor de arquivo com posição própria.
+
+    Usa `os.pread`, que não altera o offset compartilhado do descritor, de modo
+    que várias threads podem ler o mesmo arquivo de forma independente.
+    """
+
+    def __init__(self, fd: int):
+        self._fd = fd
+        self._pos = 0
+        self._size = os.fstat(fd).st_size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        data = os.pread(self._fd, len(buffer), self._pos)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+def _upload_fileno(src) -> int or None:
+    """Retorna o descritor do arquivo em disco por trás do upload, se houver."""
+    # Um SpooledTemporaryFile ainda em memória seria forçado a ir para o disco por fileno()
+    if isinstance(src, tempfile.SpooledTemporaryFile) and not getattr(src, '_rolled', True):
+        return None
+    try:
+        return src.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def _extract_zip_members(fd: int, member_names: list, dest_dir: str):
+    """Extrai um subconjunto de entradas do .zip usando um leitor próprio."""
+    # ZipFile não é thread-safe: cada worker usa seu próprio handle e offset
+    with io.BufferedReader(_PositionalFile(fd), ZIP_READ_BUFFER_SIZE) as reader:
+        with zipfile.ZipFile(reader) as zf:
+            for name in member_names:
+                zf.extract(name, dest_dir)
+
+def extract_zip(src, dest_dir: str):
+    """
+    Descompacta o .zip recebido (`src`, o arquivo do upload) em `dest_dir`,
+    lendo diretamente do upload, sem gravar uma cópia do .zip em disco.
+
+    Se o upload já está em disco, as entradas são distribuídas entre
+    `ZIP_EXTRACT_WORKERS` threads (a descompressão do zlib libera o GIL);
+    uploads pequenos, ainda em memória, são extraídos sequencialmente.
+    """
+    fd = _upload_fileno(src)
+    if fd is None:
+        # Upload pequeno, ainda em memória (no máximo 1 MiB). Antes do Python
+        # 3.11 o SpooledTemporaryFile não tem `seekable()`, exigido pelo
+        # zipfile ao abrir as entradas, então os bytes são lidos para um BytesIO.
+        with zipfile.ZipFile(io.BytesIO(src.read())) as zf:
+            zf.extractall(dest_dir)
+        return
+
+    with zipfile.ZipFile(src) as zf:
+        names = zf.namelist()
+        # Os diretórios são criados antes, em série: o `extract` cria os
+        # diretórios pais com um teste-e-cria que não é seguro entre threads, e
+        # entradas de uma mesma pasta são extraídas por workers diferentes. Uma
+        # entrada de diretório avulsa reaproveita a sanitização de caminhos do zipfile.
+        parent_dirs = {name.rpartition('/')[0] for name in names}
+        for parent_dir in sorted(parent_dirs - {''}):
+            zf.extract(zipfile.ZipInfo(parent_dir + '/'), dest_dir)
+    if not names:
+        return
+
+    workers = min(ZIP_EXTRACT_WORKERS, len(names))
+    chunks = [names[i::workers] for i in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() propaga exceções dos workers
+        list(executor.map(lambda chunk: _extract_zip_members(fd, chunk, dest_dir), chunks))
+
+def _iter_files(root: str):
+    """Percorre `root` recursivamente, gerando os `os.DirEntry` de arquivos."""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path)
+            else:
+                yield entry
+
 def background_processing_task(temp_dir: str, original_filename: str):
     """
     Tarefa executada em background para processar o arquivo .zip.
@@ -64,34 +205,37 @@ def background_processing_task(temp_dir: str, original_filename: str):
         # 1. Encontrar o arquivo .txt e mapear arquivos de mídia
         txt_file_path = None
         media_files_map = {} # Mapeia filename -> local_path
-        for root, _, files in os.walk(temp_dir):
-            for file in files:
-                if file.endswith('.txt'):
-                    txt_file_path = os.path.join(root, file)
-                elif not file.startswith('.'): # Ignorar arquivos ocultos
-                    media_files_map[file] = os.path.join(root, file)
+        for entry in _iter_files(temp_dir):
+            name = entry.name
+            if name[0] == '.': # Ignorar arquivos ocultos
+                continue
+            if txt_file_path is None and name.endswith('.txt'):
+                txt_file_path = entry.path
+            else:
+                media_files_map[name] = entry.path
         
         if not txt_file_path:
             raise ValueError("Nenhum arquivo .txt encontrado no .zip.")
 
         # 2. Parsear o arquivo de chat
         logging.info(f"Arquivo de chat encontrado: {txt_file_path}")
-        group_name, parsed_messages = parse_whatsapp_chat(txt_file_path)
-        
-        if not group_name or not parsed_messages:
-            raise ValueError("Falha ao parsear o nome do grupo ou as mensagens.")
-
-        logging.info(f"Grupo '{group_name}' parseado com {len(parsed_messages)} mensagens.")
+        group_name = extract_group_name(txt_file_path)
 
         # 3. Salvar mensagens no Firestore e fazer upload de mídias no GCS
+        # As mensagens são parseadas sob demanda e gravadas em blocos, sem
+        # manter a lista completa em memória.
         # A lógica de upload foi movida para dentro de `process_and_save_messages`
-        process_and_save_messages(
+        message_count = process_and_save_messages(
             group_name=group_name,
-            messages=parsed_messages,
+            messages=iter_whatsapp_messages(txt_file_path),
             media_files_map=media_files_map,
             gcs_bucket_name=GCS_BUCKET_NAME
         )
-        
+
+        if not message_count:
+            raise ValueError("Falha ao parsear o nome do grupo ou as mensagens.")
+
+        logging.info(f"Grupo '{group_name}' processado com {message_count} mensagens.")
         logging.info("Todas as mensagens foram processadas e salvas no Firestore com sucesso.")
         log_system_event(
             task_id,
@@ -109,13 +253,18 @@ def background_processing_task(temp_dir: str, original_filename: str):
             status='error'
         )
     finally:
-        # 4. Limpar o diretório temporário
-        shutil.rmtree(temp_dir)
-        logging.info(f"Diretório temporário {temp_dir} limpo.")
+        # 4. Descartar o diretório temporário (removido em background)
+        discard_temp_dir(temp_dir)
+        logging.info(f"Diretório temporário {temp_dir} descartado.")
+
 
+async def _run_ingestion(temp_dir: str, original_filename: str):
+    """Executa `background_processing_task` no pool de threads de ingestão."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(app.state.ingestion_pool, background_processing_task, temp_dir, original_filename)
 
 @app.post("/ingest/upload", status_code=202)
-async def upload_whatsapp_zip(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def upload_whatsapp_zip(file: UploadFile = File(...)):
     """
     Recebe um arquivo .zip exportado do WhatsApp, o descompacta e inicia
     uma tarefa em background para processar seu conteúdo.
@@ -129,18 +278,16 @@ async def upload_whatsapp_zip(background_tasks: BackgroundTasks, file: UploadFil
     temp_dir = f"/tmp/{uuid.uuid4()}"
     os.makedirs(temp_dir, exist_ok=True)
     
-    file_path = os.path.join(temp_dir, file.filename)
-
     try:
-        # Salvar o arquivo .zip
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # Descompactar o arquivo
-        shutil.unpack_archive(file_path, temp_dir)
+        # Descompactar o arquivo diretamente do upload, fora do event loop, para
+        # não bloquear outras requisições durante a extração
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, extract_zip, file.file, temp_dir)
         
-        # Adicionar a tarefa de processamento para ser executada em background
-        background_tasks.add_task(background_processing_task, temp_dir, file.filename)
+        # Agendar o processamento no pool de ingestão, sem bloquear a resposta
+        task = asyncio.create_task(_run_ingestion(temp_dir, file.filename))
+        app.state.pending_ingestions.add(task)
+        task.add_done_callback(app.state.pending_ingestions.discard)
 
         return JSONResponse(
             status_code=202,
@@ -155,6 +302,41 @@ async def upload_whatsapp_zip(background_tasks: BackgroundTasks, file: UploadFil
         logging.error(f"Erro ao receber ou descompactar o arquivo: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro interno ao processar o arquivo: {str(e)}")
 
+@app.on_event("startup")
+def start_trash_sweeper():
+    """
+    Cria o diretório de descarte e inicia a thread que o esvazia periodicamente.
+    """
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    threading.Thread(target=_trash_sweeper, name="trash-sweeper", daemon=True).start()
+
+@app.on_event("startup")
+async def start_ingestion_pool():
+    """
+    Cria o pool de threads que processa os arquivos recebidos. Uploads
+    simultâneos são processados em paralelo, até `INGESTION_WORKERS` por vez.
+    """
+    app.state.ingestion_pool = ThreadPoolExecutor(max_workers=INGESTION_WORKERS, thread_name_prefix="ingestion")
+    app.state.pending_ingestions = set()
+
+@app.on_event("shutdown")
+async def drain_ingestion_pool():
+    """
+    Aguarda o fim dos processamentos em andamento antes de o processo encerrar.
+    """
+    if app.state.pending_ingestions:
+        logging.info(f"Aguardando {len(app.state.pending_ingestions)} processamentos em andamento...")
+        await asyncio.gather(*app.state.pending_ingestions, return_exceptions=True)
+    app.state.ingestion_pool.shutdown(wait=True)
+
+@app.on_event("shutdown")
+def flush_pending_logs():
+    """
+    Garante que os eventos do log do sistema ainda enfileirados sejam gravados
+    antes de o processo encerrar.
+    """
+    flush_system_logs()
+
 @app.get("/health", status_code=200)
 async def health_check():
     """
@@ -1,129 +1,308 @@
-import re
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from typing import Iterable, Iterator, NamedTuple, Optional
 import logging
 
-# Configuração básica de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Usa o módulo `regex`, de matching mais rápido, quando instalado; a sintaxe
+# dos padrões é compatível com a do `re` da biblioteca padrão.
+try:
+    import regex as _re
+except ImportError:
+    import re as _re
 
-# Regex aprimorada para o formato "DD/MM/YYYY HH:MM - Autor: Mensagem"
-WHATSAPP_MESSAGE_REGEX = re.compile(
-    r"^(?P<date>\d{1,2}/\d{1,2}/\d{2,4})\s(?P<time>\d{1,2}:\d{2})\s-\s(?P<author>[^:]+):\s(?P<message>.+)",
-    re.DOTALL
+def configure_logging():
+    """
+    Configuração básica de logging, para quem usa o parser fora da aplicação.
+
+    Não é feita na importação do módulo, para não alterar a configuração de
+    logging de quem o importa.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Ponto de divisão do arquivo em mensagens: a quebra de linha que antecede cada
+# linha de cabeçalho "DD/MM/YYYY HH:MM - ...". Começar pelo literal "\n" permite
+# ao motor de regex saltar direto entre quebras de linha, testando o lookahead
+# só nelas. `[^\S\n]` é qualquer espaço em branco exceto quebra de linha.
+HEADER_SPLIT_REGEX = _re.compile(
+    r"\n(?=[^\S\n]*\d{1,2}/\d{1,2}/\d{2,4}[^\S\n]\d{1,2}:\d{2}[^\S\n]-[^\S\n][^\n])"
 )
 
-# Regex para mensagens de sistema, que não possuem um "Autor:"
-SYSTEM_MESSAGE_REGEX = re.compile(
-    r"^(?P<date>\d{1,2}/\d{1,2}/\d{2,4})\s(?P<time>\d{1,2}:\d{2})\s-\s(?P<message>(?!.+:).+)"
+# Regex para a linha de cabeçalho de uma mensagem: "DD/MM/YYYY HH:MM - Autor: Mensagem".
+# O autor é opcional: sem ele, a mensagem é de sistema.
+LINE_REGEX = _re.compile(
+    r"[^\S\n]*(?P<date>\d{1,2}/\d{1,2}/\d{2,4})[^\S\n](?P<time>\d{1,2}:\d{2})[^\S\n]-[^\S\n]"
+    r"(?:(?P<author>[^:\n]+):[^\S\n])?(?P<message>[^\n]+)"
 )
 
-# Regex para extrair o nome do grupo do nome do arquivo
-GROUP_NAME_REGEX = re.compile(r"Conversa do WhatsApp com (.+?)\.txt")
+# Prefixo e sufixo fixos do nome do arquivo de exportação, ao redor do nome do grupo
+GROUP_FILE_PREFIX = "Conversa do WhatsApp com "
+GROUP_FILE_SUFFIX = ".txt"
 
-MEDIA_PLACEHOLDERS = [
+# Regex para nomes de arquivos de mídia: IMG, VID, PTT, DOC, STK e outros formatos
+MEDIA_FILENAME_REGEX = _re.compile(
+    r"((?:IMG|VID|PTT|DOC|STK)-\d{8}-WA\d{4,}\.\w+)",
+    _re.IGNORECASE
+)
+
+# Tamanho dos blocos lidos do arquivo de chat
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Tupla imutável: com tão poucos marcadores, testes de substring com `in` são
+# mais rápidos que uma alternação compilada em regex.
+MEDIA_PLACEHOLDERS = (
     "(arquivo anexado)",
     "<Arquivo de mídia oculto>",
     "<Mídia oculta>"
-]
+)
+
+class ParsedMessage(NamedTuple):
+    """Mensagem extraída do arquivo de exportação do WhatsApp."""
+    timestamp_utc: datetime
+    author: str
+    message_text: str
+    is_system_message: bool
+    has_media: bool
+    media_filename: Optional[str]
 
+@lru_cache(maxsize=8192)
 def _parse_timestamp(date_str: str, time_str: str) -> datetime or None:
-    """Tenta fazer o parse de strings de data e hora com o formato do WhatsApp."""
+    """
+    Tenta fazer o parse de strings de data e hora com o formato do WhatsApp.
+
+    Os resultados são cacheados, pois mensagens de uma mesma conversa costumam
+    compartilhar o mesmo minuto. Retorna None se o parse falhar.
+    """
+    # O LINE_REGEX já garante os grupos de dígitos, então o parse é feito
+    # diretamente com int() em vez do `strptime`, bem mais lento.
     try:
-        return datetime.strptime(f"{date_str} {time_str}", "%d/%m/%Y %H:%M")
+        day, month, year = date_str.split('/')
+        hour, minute = time_str.split(':')
+        year = int(year)
+        if year < 100:
+            # Exportações com ano de dois dígitos (DD/MM/YY)
+            year += 2000
+        return datetime(year, int(month), int(day), int(hour), int(minute))
     except ValueError:
-        logging.warning(f"Não foi possível parsear a data/hora: {date_str} {time_str}")
         return None
 
+def _iter_chunks(file) -> Iterator[str]:
+    """
+    Lê o arquivo em blocos de `READ_BLOCK_SIZE` e gera seus trechos, um por
+    mensagem (cabeçalho + continuação), mantendo em memória só o trecho em
+    aberto. O que vem antes do primeiro cabeçalho é descartado.
+    """
+    # O "\n" inicial faz um cabeçalho na primeira linha também ser precedido
+    # por uma quebra de linha.
+    buffer = "\n"
+    start = None  # Início, no buffer, do trecho da mensagem em aberto
+    search_pos = 0
+    while True:
+        data = file.read(READ_BLOCK_SIZE)
+        if data:
+            buffer += data
+            # Só as quebras de linha cuja linha seguinte já foi lida por
+            # completo podem ser testadas como início de cabeçalho.
+            end = buffer.rfind("\n")
+        else:
+            end = len(buffer)
+
+        for boundary in HEADER_SPLIT_REGEX.finditer(buffer, search_pos, end):
+            if start is not None:
+                yield buffer[start:boundary.start()]
+            start = boundary.end()
+
+        if not data:
+            break
+
+        # Descarta o que já foi consumido
+        consumed = end if start is None else start
+        buffer = buffer[consumed:]
+        if start is not None:
+            start = 0
+        search_pos = end - consumed
+
+    if start is not None:
+        yield buffer[start:]
+
+def _split_lines(text: str) -> list:
+    """Divide o texto em linhas sem espaços nas bordas, descartando as vazias."""
+    text = text.strip()
+    if not text:
+        return []
+    if "\n" not in text:
+        return [text]
+    return [line for line in (raw.strip() for raw in text.split("\n")) if line]
+
+def _finish_message(timestamp_dt: datetime, author: str, text_parts: list) -> ParsedMessage:
+    """
+    Monta a `ParsedMessage`, unindo as linhas acumuladas do texto uma única vez
+    e procurando os marcadores e o nome do arquivo de mídia no texto completo.
+    """
+    message_text = "\n".join(text_parts)
+    # Mesmo teste de `extract_media_filename`, em linha para evitar a chamada
+    # de função a cada mensagem.
+    media_filename = None
+    if "-WA" in message_text or "-wa" in message_text or "-Wa" in message_text or "-wA" in message_text:
+        if (media_match := MEDIA_FILENAME_REGEX.search(message_text)):
+            media_filename = media_match.group(0)
+    # Todo marcador de mídia começa com "(" ou "<": o teste barato descarta a
+    # maioria das mensagens antes de procurar cada marcador.
+    has_media = (
+        ("(" in message_text or "<" in message_text)
+        and any(placeholder in message_text for placeholder in MEDIA_PLACEHOLDERS)
+    )
+    return ParsedMessage(
+        timestamp_dt,
+        author,
+        message_text,
+        False,
+        has_media,
+        media_filename
+    )
+
+def extract_group_name(file_path: str) -> str:
+    """
+    Extrai o nome do grupo do nome do arquivo de exportação do WhatsApp.
+    """
+    file_name = os.path.basename(file_path)
+    # Prefixo e sufixo são literais, então basta removê-los, sem regex
+    group_name = None
+    if file_name.startswith(GROUP_FILE_PREFIX) and file_name.endswith(GROUP_FILE_SUFFIX):
+        group_name = file_name.removeprefix(GROUP_FILE_PREFIX).removesuffix(GROUP_FILE_SUFFIX).strip()
+    return group_name or "Nome de Grupo Desconhecido"
+
+def iter_whatsapp_messages(file_path: str) -> Iterator[ParsedMessage]:
+    """
+    Percorre um arquivo de texto de exportação do WhatsApp, produzindo cada
+    mensagem como `ParsedMessage` assim que ela termina.
+
+    O arquivo é lido em blocos e nenhuma lista de mensagens é montada, então a
+    memória usada não cresce com o tamanho do arquivo e o consumidor pode
+    gravar as mensagens de forma incremental. Erros de leitura são propagados
+    ao consumidor.
+    """
+    logging.info(f"Iniciando parsing do arquivo: {file_path}")
+
+    message_count = 0
+    bad_timestamp_count = 0
+
+    # Estado da mensagem de usuário em aberto, em variáveis locais em vez
+    # de um dict: o laço roda uma vez por mensagem e cada acesso conta.
+    current_timestamp = None
+    current_author = None
+    current_parts = None
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        # Cada bloco é uma mensagem inteira (cabeçalho + continuação)
+        for chunk in _iter_chunks(f):
+            match = LINE_REGEX.match(chunk)
+            # A forma com vários argumentos de `group()` devolve uma tupla, sem
+            # montar um dict por mensagem como `groupdict()`.
+            date_str, time_str, author, message = match.group('date', 'time', 'author', 'message')
+            timestamp_dt = _parse_timestamp(date_str, time_str)
+
+            if not timestamp_dt:
+                # Contabilizado e registrado uma única vez ao final do arquivo
+                bad_timestamp_count += 1
+                if current_parts is not None:
+                    current_parts.extend(_split_lines(chunk))
+                continue
+
+            # A mensagem anterior só é finalizada quando uma nova começa de
+            # fato; antes disso ela ainda pode receber linhas de continuação.
+            if current_parts is not None:
+                message_count += 1
+                yield _finish_message(current_timestamp, current_author, current_parts)
+
+            if author is None:
+                # Mensagem de sistema (sem "Autor:"); linhas de continuação são ignoradas
+                message_count += 1
+                yield ParsedMessage(
+                    timestamp_dt, "System", message.strip(), True, False, None
+                )
+                current_parts = None
+                continue
+
+            current_timestamp = timestamp_dt
+            current_author = author.strip()
+            current_parts = [message.strip(), *_split_lines(chunk[match.end():])]
+
+    if current_parts is not None:
+        message_count += 1
+        yield _finish_message(current_timestamp, current_author, current_parts)
+
+    if bad_timestamp_count:
+        logging.warning(f"Não foi possível parsear a data/hora de {bad_timestamp_count} linhas do arquivo: {file_path}")
+
+    logging.info(f"Parsing concluído. {message_count} mensagens extraídas do arquivo: {file_path}")
+
 def parse_whatsapp_chat(file_path: str) -> (str or None, list):
     """
     Realiza o parsing de um arquivo de texto de exportação do WhatsApp de forma robusta.
+
+    Retorna o nome do grupo e a lista de mensagens como `ParsedMessage`.
     """
-    logging.info(f"Iniciando parsing do arquivo: {file_path}")
-    
-    file_name = os.path.basename(file_path)
-    group_name_match = GROUP_NAME_REGEX.search(file_name)
-    group_name = group_name_match.group(1).strip() if group_name_match else "Nome de Grupo Desconhecido"
-    
-    messages = []
-    
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            current_message_data = None
-            
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-
-                match = WHATSAPP_MESSAGE_REGEX.match(line)
-                
-                if match:
-                    if current_message_data:
-                        messages.append(current_message_data)
-
-                    data = match.groupdict()
-                    timestamp_dt = _parse_timestamp(data['date'], data['time'])
-                    
-                    if not timestamp_dt:
-                        if current_message_data:
-                            current_message_data["message_text"] += "\n" + line
-                        continue
-
-                    text = data['message']
-                    current_message_data = {
-                        "timestamp_utc": timestamp_dt,
-                        "author": data['author'].strip(),
-                        "message_text": text.strip(),
-                        "is_system_message": False,
-                        "has_media": any(placeholder in text for placeholder in MEDIA_PLACEHOLDERS),
-                        "media_filename": extract_media_filename(text)
-                    }
-                elif current_message_data:
-                    # Linha de continuação de uma mensagem anterior
-                    current_message_data["message_text"] += "\n" + line
-                    if not current_message_data["has_media"]:
-                        current_message_data["has_media"] = any(placeholder in line for placeholder in MEDIA_PLACEHOLDERS)
-                    if not current_message_data["media_filename"]:
-                        current_message_data["media_filename"] = extract_media_filename(line)
-                else:
-                    # Tenta identificar como mensagem de sistema
-                    system_match = SYSTEM_MESSAGE_REGEX.match(line)
-                    if system_match:
-                        if current_message_data:
-                            messages.append(current_message_data)
-                            current_message_data = None
-                        
-                        data = system_match.groupdict()
-                        timestamp_dt = _parse_timestamp(data['date'], data['time'])
-
-                        if timestamp_dt:
-                            messages.append({
-                                "timestamp_utc": timestamp_dt,
-                                "author": "System",
-                                "message_text": data['message'].strip(),
-                                "is_system_message": True,
-                                "has_media": False,
-                                "media_filename": None
-                            })
-
-            if current_message_data:
-                messages.append(current_message_data)
+    group_name = extract_group_name(file_path)
 
+    try:
+        messages = list(iter_whatsapp_messages(file_path))
     except Exception as e:
         logging.error(f"Erro ao ler ou parsear o arquivo {file_path}: {e}", exc_info=True)
         return group_name, []
 
-    logging.info(f"Parsing concluído. {len(messages)} mensagens extraídas para o grupo '{group_name}'.")
     return group_name, messages
 
+def parse_whatsapp_chat_columnar(file_path: str) -> (str or None, dict):
+    """
+    Variante colunar de `parse_whatsapp_chat`.
+
+    Retorna o nome do grupo e um dict com uma lista por campo de
+    `ParsedMessage` (`timestamp_utc`, `author`, ...), todas com o mesmo tamanho,
+    prontas para conversão em massa para formatos colunares (DataFrame, Arrow).
+    """
+    group_name = extract_group_name(file_path)
+    columns = {field: [] for field in ParsedMessage._fields}
+    # As mensagens são distribuídas nas colunas à medida que são parseadas, sem
+    # manter a lista de `ParsedMessage` em memória junto com as colunas.
+    append_timestamp, append_author, append_text, append_is_system, append_has_media, append_media_filename = (
+        column.append for column in columns.values()
+    )
+
+    try:
+        for timestamp_dt, author, message_text, is_system_message, has_media, media_filename in iter_whatsapp_messages(file_path):
+            append_timestamp(timestamp_dt)
+            append_author(author)
+            append_text(message_text)
+            append_is_system(is_system_message)
+            append_has_media(has_media)
+            append_media_filename(media_filename)
+    except Exception as e:
+        logging.error(f"Erro ao ler ou parsear o arquivo {file_path}: {e}", exc_info=True)
+        return group_name, {field: [] for field in ParsedMessage._fields}
+
+    return group_name, columns
+
+def parse_many(paths: Iterable[str], workers: int = None) -> list:
+    """
+    Faz o parsing de vários arquivos de exportação em paralelo, um por processo.
+
+    O parsing é limitado pelo GIL (regex e montagem de objetos), por isso usa
+    processos em vez de threads. `workers` segue o padrão do
+    `ProcessPoolExecutor` (número de CPUs) quando omitido. Retorna a lista de
+    tuplas `(group_name, messages)` na mesma ordem de `paths`.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(parse_whatsapp_chat, paths, chunksize=4))
+
 def extract_media_filename(text: str) -> str or None:
     """
     Extrai um nome de arquivo de mídia do texto da mensagem, se existir.
     """
-    # Regex para cobrir IMG, VID, PTT, DOC, STK e outros formatos de mídia
-    media_filename_regex = re.compile(
-        r"((?:IMG|VID|PTT|DOC|STK)-\d{8}-WA\d{4,}\.\w+)",
-        re.IGNORECASE
-    )
-    match = media_filename_regex.search(text)
+    # Teste barato primeiro: todo nome de arquivo de mídia contém "-WA" (em
+    # qualquer caixa), o que descarta a maioria das mensagens sem rodar a regex.
+    if "-WA" not in text and "-wa" not in text and "-Wa" not in text and "-wA" not in text:
+        return None
+    match = MEDIA_FILENAME_REGEX.search(text)
     return match.group(0) if match else None
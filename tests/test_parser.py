@@ -0,0 +1,139 @@
+import os
+import random
+import re
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+# O diretório do serviço vem antes da biblioteca padrão, que no Python 3.9
+# ainda tem um módulo `parser` próprio.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parser  # noqa: E402
+
+# Parser de referência, linha a linha, com a mesma semântica do parser original
+REFERENCE_LINE_REGEX = re.compile(
+    r"(?P<date>\d{1,2}/\d{1,2}/\d{2,4})\s(?P<time>\d{1,2}:\d{2})\s-\s(?:(?P<author>[^:]+):\s)?(?P<message>.+)",
+    re.DOTALL
+)
+
+def _reference_timestamp(date_str: str, time_str: str) -> datetime or None:
+    day, month, year = (int(part) for part in date_str.split('/'))
+    hour, minute = (int(part) for part in time_str.split(':'))
+    if year < 100:
+        year += 2000
+    try:
+        return datetime(year, month, day, hour, minute)
+    except ValueError:
+        return None
+
+def _reference_message(timestamp_dt: datetime, author: str, text_parts: list) -> parser.ParsedMessage:
+    message_text = "\n".join(text_parts)
+    media_match = parser.MEDIA_FILENAME_REGEX.search(message_text)
+    return parser.ParsedMessage(
+        timestamp_dt,
+        author,
+        message_text,
+        False,
+        any(placeholder in message_text for placeholder in parser.MEDIA_PLACEHOLDERS),
+        media_match.group(0) if media_match else None
+    )
+
+def reference_parse(file_path: str) -> list:
+    """Percorre o arquivo linha a linha, como o parser antes da leitura em blocos."""
+    messages = []
+    current = None
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            match = REFERENCE_LINE_REGEX.match(line)
+            if not match:
+                if current:
+                    current[2].append(line)
+                continue
+
+            timestamp_dt = _reference_timestamp(match['date'], match['time'])
+            if not timestamp_dt:
+                if current:
+                    current[2].append(line)
+                continue
+
+            if current:
+                messages.append(_reference_message(*current))
+            if match['author'] is None:
+                messages.append(parser.ParsedMessage(
+                    timestamp_dt, "System", match['message'].strip(), True, False, None
+                ))
+                current = None
+            else:
+                current = (timestamp_dt, match['author'].strip(), [match['message'].strip()])
+
+    if current:
+        messages.append(_reference_message(*current))
+    return messages
+
+# Linhas usadas para montar as exportações aleatórias: cabeçalhos válidos e
+# inválidos, mensagens de sistema, continuações, mídias e espaços nas bordas.
+FUZZ_LINES = [
+    "01/02/2024 10:15 - João: oi",
+    "01/02/2024 10:15 - João: oi: tudo",
+    "1/2/24 9:05 - Ana: IMG-20240201-WA0001.jpg (arquivo anexado)",
+    "31/13/2024 10:20 - Zé: inválida",
+    "01/02/2024 10:16 - Carlos saiu",
+    "continuação",
+    "  espaçada  ",
+    "",
+    "   ",
+    "<Mídia oculta>",
+    "PTT-20240203-WA0003.opus",
+    "01/02/2024 10:17 - ",
+    "01/02/2024 10:17 -",
+    "texto com 10:30 - coisa",
+    "01/02/2024 10:18 - Bia: ",
+    "  01/02/2024 10:19 - Lu: lead",
+    "01/02/2024 10:20 - X: nbsp",
+    "abc: def",
+    "\t01/02/2024 10:21 - Sys msg x",
+]
+
+BLOCK_SIZES = [1, 2, 3, 5, 8, 17, 64, parser.READ_BLOCK_SIZE]
+
+class ParserBlockReaderTest(unittest.TestCase):
+    """Compara o parser em blocos com o parser de referência linha a linha."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.file_path = os.path.join(temp_dir.name, "Conversa do WhatsApp com Grupo.txt")
+
+    def _write(self, text: str):
+        with open(self.file_path, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+
+    def test_matches_line_based_reference(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            newline = rng.choice(["\n", "\r\n", "\r"])
+            lines = [rng.choice(FUZZ_LINES) for _ in range(rng.randint(0, 12))]
+            text = newline.join(lines) + rng.choice(["", newline])
+            self._write(text)
+            expected = reference_parse(self.file_path)
+
+            for block_size in BLOCK_SIZES:
+                with self.subTest(text=text, block_size=block_size), \
+                        mock.patch.object(parser, 'READ_BLOCK_SIZE', block_size):
+                    self.assertEqual(list(parser.iter_whatsapp_messages(self.file_path)), expected)
+
+    def test_header_on_first_line_and_preamble(self):
+        self._write("preâmbulo\n01/02/2024 10:15 - João: oi\nlinha 2\n01/02/2024 10:16 - Ana: fim")
+        for block_size in BLOCK_SIZES:
+            with self.subTest(block_size=block_size), mock.patch.object(parser, 'READ_BLOCK_SIZE', block_size):
+                messages = list(parser.iter_whatsapp_messages(self.file_path))
+                self.assertEqual([msg.message_text for msg in messages], ["oi\nlinha 2", "fim"])
+
+if __name__ == '__main__':
+    unittest.main()